@@ -6,6 +6,14 @@ from pathlib import Path
 import argparse
 import subprocess
 
+try:
+  import orjson
+except ImportError:
+  # orjson is much faster at parsing and serializing the (large) register
+  # dumps, but it is not part of the standard library, so fall back to json if
+  # it's not available.
+  orjson = None
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="Generate test json file")
   parser.add_argument("s19file", type=str, help="s19 file")
@@ -26,15 +34,24 @@ if __name__ == "__main__":
 
   cmd = ["m6809-run", "-d", args.s19file]
   inpt = b"json\ns\n" * 1000000
-  result = subprocess.run(
-    cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, input=inpt, check=False
+  # The snapshots are read from the regdump file, so the (very long) debugger
+  # output is discarded instead of being buffered in memory.
+  subprocess.run(
+    cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, input=inpt, check=False
   )
 
   # load the json dumps
-  with open("regdump.json", "r", encoding="utf-8") as f:
-    regdumps = json.load(f)
+  if orjson is not None:
+    regdumps = orjson.loads(regdump_file.read_bytes())
+  else:
+    with regdump_file.open("r", encoding="utf-8") as f:
+      regdumps = json.load(f)
   # remove the regdump file
   regdump_file.unlink()
 
-  with open(args.outfile, "w", encoding="utf-8") as f:
-    json.dump(regdumps, f, indent=2)
+  if orjson is not None:
+    with open(args.outfile, "wb") as f:
+      f.write(orjson.dumps(regdumps, option=orjson.OPT_INDENT_2))
+  else:
+    with open(args.outfile, "w", encoding="utf-8") as f:
+      json.dump(regdumps, f, indent=2)
@@ -1,25 +1,63 @@
 #!/usr/bin/env python3
 
+import binascii
+import re
 import sys
 
-with open(sys.argv[1], 'r', encoding="ASCII") as inf:
-  with open(sys.argv[2], "wb") as outf:
-    for line in inf.readlines():
-      line = line.strip()
-
-      recordtype = line[:2]
-      bytecount = int(line[2:4], 16)
-      address = int(line[4:8], 16)
-      data = line[8:-2]
-      checksum = line[-2:]
-    
-      if recordtype == "S0":
-        print(f"S0 (Header): {data}")
-      elif recordtype == "S1":
-        print(f"S1 (Data): {data}")
-        outf.seek(address, 0)
-        outf.write(bytes.fromhex(data))
-      elif recordtype == "S9":
-        print(f"S9 (Termination): {data}")
+# Matches a whole record (surrounding spaces are allowed), capturing its type,
+# address and data (the byte count and checksum are not needed).
+RECORD_RE = re.compile(
+  rb"^[ \t]*(S[0-9])[0-9A-Fa-f]{2}([0-9A-Fa-f]{4})((?:[0-9A-Fa-f]{2})*)"
+  rb"[0-9A-Fa-f]{2}[ \t]*$",
+  re.MULTILINE,
+)
+# Matches any line that isn't blank.
+LINE_RE = re.compile(rb"^.*\S", re.MULTILINE)
 
+NAMES = {b"S0": "Header", b"S1": "Data", b"S9": "Termination"}
 
+with open(sys.argv[1], "rb") as inf:
+  # Accept any line ending (like reading in text mode would), so that the
+  # regexes only have to deal with '\n'.
+  buf = inf.read().replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+  records = RECORD_RE.findall(buf)
+
+# Every line that isn't blank must be a record, otherwise part of the memory
+# image would be silently lost.
+if len(records) != len(LINE_RE.findall(buf)):
+  for line in buf.split(b"\n"):
+    if line.strip() and not RECORD_RE.fullmatch(line):
+      sys.exit(f"error: malformed S19 record: {line.decode(errors='replace')}")
+  sys.exit("error: malformed S19 file")
+
+addresses = []
+hexdata = []
+for recordtype, address, data in records:
+  if recordtype not in NAMES:
+    continue
+  print(f"{recordtype.decode()} ({NAMES[recordtype]}): {data.decode()}")
+  if recordtype == b"S1":
+    addresses.append(int(address, 16))
+    hexdata.append(data)
+
+# Decode the data of all the S1 records at once.
+data = memoryview(binascii.unhexlify(b"".join(hexdata)))
+
+image = bytearray(addresses[0] if addresses else 0)
+offset = 0
+for address, chunk in zip(addresses, hexdata):
+  size = len(chunk) // 2
+  if address == len(image):
+    # Records are usually in address order, so this is just an append.
+    image += data[offset : offset + size]
+  else:
+    # Place the data in the memory image, filling any gap with zeros (like
+    # seeking past the end of the output file would).
+    end = address + size
+    if len(image) < end:
+      image.extend(bytes(end - len(image)))
+    image[address:end] = data[offset : offset + size]
+  offset += size
+
+with open(sys.argv[2], "wb") as outf:
+  outf.write(image)